@@ -1,17 +1,32 @@
 
 import os
 import re
+import signal
+import io
+import csv
+import hmac
+import json
+import math
+import sys
 import sqlite3
 import asyncio
+import threading
+import tempfile
 import time
-from datetime import datetime, timedelta
+import tracemalloc
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta, date
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
-from aiohttp import web, ClientSession
+from aiohttp import web, ClientSession, FormData
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.types import BotCommand, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
@@ -21,6 +36,12 @@ try:
 except Exception:
     llm_short_reply = None
 
+# Optional numpy for local notes recall (без него /q ищет только по подстроке)
+try:
+    import numpy as np
+except Exception:
+    np = None
+
 # ── ENV ────────────────────────────────────────────────────────────────────
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -32,11 +53,60 @@ WEBHOOK_SECRET = os.getenv("TG_SECRET", "hooksecret")
 WEBHOOK_PATH = f"/tg/{WEBHOOK_SECRET}"
 
 OWM_KEY = os.getenv("OWM_API_KEY")
+# Токен для служебных HTTP-ручек (/import/..., /debug/memory, /debug/profile). Без него ручки закрыты.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Бюджет памяти процесса. Интерпретатор с aiogram и numpy уже занимают свою часть,
+# поэтому лимиты кэшей считаются от запаса: бюджет минус RSS после импортов (см. _budget).
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "256"))
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576
+    except Exception:
+        return 0.0
+
+RSS_BASELINE_MB = _rss_mb()
+MEMORY_HEADROOM_MB = max(0.0, MEMORY_BUDGET_MB - RSS_BASELINE_MB)
+if RSS_BASELINE_MB > MEMORY_BUDGET_MB * 0.9:
+    print(f"[mem] MEMORY_BUDGET_MB={MEMORY_BUDGET_MB} leaves no headroom over baseline RSS {RSS_BASELINE_MB:.0f}MB, "
+          "caches get minimal sizes")
+if os.getenv("TRACEMALLOC") == "1":
+    tracemalloc.start(int(os.getenv("TRACEMALLOC_FRAMES", "1")))
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+# Неизменяемые reply_markup (клавиатуры) сериализуются в JSON один раз и
+# переиспользуются при каждой отправке вместо model_dump + json на каждый ответ.
+_prepared = {}  # id(markup) -> [markup, json или None до первой отправки]
+
+def _prepare(markup):
+    _prepared[id(markup)] = [markup, None]
+    return markup
+
+class _PreparedSession(AiohttpSession):
+    def build_form_data(self, bot, method):
+        markup = getattr(method, "reply_markup", None)
+        entry = _prepared.get(id(markup)) if markup is not None else None
+        if entry is None or entry[0] is not markup:
+            return super().build_form_data(bot, method)
+        files = {}
+        if entry[1] is None:
+            entry[1] = self.prepare_value(markup.model_dump(warnings=False), bot=bot, files=files)
+        form = FormData(quote_fields=False)
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field("reply_markup", entry[1])
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+bot = Bot(token=BOT_TOKEN, session=_PreparedSession(), default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 
 # ── DB ─────────────────────────────────────────────────────────────────────
@@ -61,6 +131,16 @@ def _open_db():
 
 db = _open_db()
 cur = db.cursor()
+# путь к файлу БД ("" для in-memory) — для отдельных соединений из фоновых потоков
+DB_FILE = db.execute("PRAGMA database_list").fetchone()[2]
+# WAL: чтения основного соединения не ждут записи из фоновых потоков
+cur.execute("PRAGMA journal_mode=WAL")
+
+def _thread_db():
+    """Своё соединение для фонового потока; in-memory БД так не открыть — тогда None."""
+    return sqlite3.connect(DB_FILE, timeout=30) if DB_FILE else None
+# page cache SQLite — 5% запаса памяти (отрицательное значение = KiB)
+cur.execute(f"PRAGMA cache_size=-{max(512, int(MEMORY_HEADROOM_MB * 1024 // 20))}")
 
 cur.execute("""CREATE TABLE IF NOT EXISTS users (
     user_id INTEGER PRIMARY KEY,
@@ -111,9 +191,84 @@ cur.execute("""CREATE TABLE IF NOT EXISTS rituals_sent (
     which TEXT,
     ts DATETIME DEFAULT CURRENT_TIMESTAMP
 )""")
+cur.execute("""CREATE TABLE IF NOT EXISTS digests (
+    user_id INTEGER PRIMARY KEY,
+    last_mood_id INTEGER,
+    body TEXT,
+    ts DATETIME DEFAULT CURRENT_TIMESTAMP
+)""")
+cur.execute("CREATE INDEX IF NOT EXISTS idx_moods_user_day ON moods(user_id, day)")
+cur.execute("CREATE INDEX IF NOT EXISTS idx_qanswers_user_ts ON qanswers(user_id, ts)")
 db.commit()
 
 # ── HELPERS ────────────────────────────────────────────────────────────────
+def _budget(env: str, share: float, unit_bytes: int, floor: int = 16) -> int:
+    """Лимит из ENV или доля запаса памяти (MEMORY_HEADROOM_MB), поделённая на размер одной записи."""
+    v = os.getenv(env)
+    if v:
+        return int(v)
+    return max(floor, int(MEMORY_HEADROOM_MB * 1024 * 1024 * share / unit_bytes))
+
+_caches = {}
+
+class _TTLCache:
+    """dict с LRU-вытеснением по числу записей и суммарному весу и с временем жизни."""
+    _MISS = object()
+
+    def __init__(self, name: str, maxsize: int, ttl: float = 0, weigh=None, maxweight: int = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.maxweight = maxweight
+        self.weight = 0
+        self._d = OrderedDict()  # key -> (expires, weight, value)
+        _caches[name] = self
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return self.get(key, self._MISS) is not self._MISS
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        w = self.weigh(value) if self.weigh else 0
+        self._d[key] = (time.monotonic() + self.ttl if self.ttl else 0, w, value)
+        self.weight += w
+        while len(self._d) > self.maxsize or (self.maxweight and self.weight > self.maxweight and len(self._d) > 1):
+            _, (_, w0, _) = self._d.popitem(last=False)
+            self.weight -= w0
+
+    def get(self, key, default=None):
+        item = self._d.get(key)
+        if item is None:
+            return default
+        if item[0] and item[0] < time.monotonic():
+            self.pop(key)
+            return default
+        self._d.move_to_end(key)
+        return item[2]
+
+    def pop(self, key, default=None):
+        item = self._d.pop(key, None)
+        if item is None:
+            return default
+        self.weight -= item[1]
+        return default if item[0] and item[0] < time.monotonic() else item[2]
+
+    def purge(self):
+        now = time.monotonic()
+        for key in [k for k, it in self._d.items() if it[0] and it[0] < now]:
+            self.pop(key)
+
+    def clear(self):
+        self._d.clear()
+        self.weight = 0
+
+    def items(self):
+        now = time.monotonic()
+        return [(k, it[2]) for k, it in self._d.items() if not it[0] or it[0] >= now]
+
 def _now_in_tz(tz: str) -> datetime:
     try:
         return datetime.now(ZoneInfo(tz))
@@ -161,64 +316,455 @@ def log_chat(uid: int, role: str, content: str):
     except Exception:
         pass
 
-async def _ai_answer_with_ctx(uid: int, text: str) -> str:
+# Notes recall: локальный поиск похожих заметок без сети.
+# Слова и их префиксы (NOTES_PREFIX символов — грубый стемминг, «энтальпию» ~
+# «энтальпия») хешируются в NOTES_DIM корзин; заметка хранится разреженно
+# (только свои корзины) с весами TF-IDF, нормированными по L2. Поиск идёт по
+# инвертированному индексу: складываются только списки корзин из запроса.
+NOTES_DIM = int(os.getenv("NOTES_DIM", "4096"))  # не больше 65536 (uint16)
+NOTES_MIN_SIM = float(os.getenv("NOTES_MIN_SIM", "0.25"))
+NOTES_PREFIX = 5
+NOTES_BUILD_CHUNK = 2000  # заметок за шаг сборки
+NOTES_DELTA_MAX = 256  # заметок после сборки индекса; дальше — пересборка в потоке
+NOTES_SQL = "SELECT id, category, question, answer FROM qanswers WHERE user_id=? AND id>? ORDER BY id"
+
+NOTE_PLACEHOLDERS = ("user-flow", "import")  # question у заметок без вопроса
+
+def _note_text(cat, question, answer) -> str:
+    q = "" if question in NOTE_PLACEHOLDERS else question
+    return f"{cat} {q} {answer}"
+
+def _note_title(cat, question) -> str:
+    return cat if question in NOTE_PLACEHOLDERS else question
+
+def _word_feats(w: str):
+    """-> (корзина слова, корзина префикса или -1)"""
+    p = zlib.crc32(w[:NOTES_PREFIX].encode() + b"~") % NOTES_DIM if len(w) > NOTES_PREFIX else -1
+    return zlib.crc32(w.encode()) % NOTES_DIM, p
+
+def _note_feats(text: str) -> list:
+    return [f for w in re.findall(r"\w+", (text or "").lower()) for f in _word_feats(w) if f >= 0]
+
+def _note_weights(feats, idf):
+    """-> (корзины, L2-нормированные веса tf-idf)"""
+    f, c = np.unique(np.asarray(feats, np.int64), return_counts=True)
+    w = np.log1p(c).astype(np.float32) * idf[f]
+    norm = float(np.linalg.norm(w))
+    return f, (w / norm if norm else w)
+
+class _NoteIndex:
+    """Заметки одного пользователя: списки (заметка, вес) по корзинам + хвост новых заметок.
+    IDF фиксируется при сборке; тексты не храним — берём из БД по id."""
+    __slots__ = ("n", "ids", "idf", "ptr", "post_doc", "post_w", "delta", "last_id")
+
+    @classmethod
+    def build(cls, rows):
+        """rows: [(id, category, question, answer)] по возрастанию id. Тяжёлая — звать в потоке."""
+        self = cls()
+        n = self.n = len(rows)
+        # словарь слов: хешируем каждое слово один раз, дальше всё векторно
+        # кусками, чтобы длинные C-вызовы не держали GIL и event loop не замирал
+        vocab, wids, lens = {}, [], array("I")
+        word_re = re.compile(r"\w+")
+        for start in range(0, n, NOTES_BUILD_CHUNK):
+            words = []
+            for _, c, q, a in rows[start:start + NOTES_BUILD_CHUNK]:
+                ws = word_re.findall(_note_text(c, q, a).lower())
+                words += ws
+                lens.append(len(ws))
+            for w in dict.fromkeys(words):
+                if w not in vocab:
+                    vocab[w] = len(vocab)
+            wids.append(np.fromiter(map(vocab.__getitem__, words), np.int64, len(words)))
+        wid = np.concatenate(wids) if wids else np.zeros(0, np.int64)
+        vf = np.array([_word_feats(w) for w in vocab], np.int64).reshape(-1, 2)
+        doc = np.repeat(np.arange(n, dtype=np.int64), np.frombuffer(lens, np.uint32))
+        feats = vf[wid].T.ravel()  # сначала корзины слов, потом префиксов
+        docs = np.concatenate((doc, doc))
+        ok = feats >= 0
+        # ключ корзина*n + заметка: после unique пары уже лежат в порядке списков корзин
+        keys, cnt = np.unique(feats[ok] * max(n, 1) + docs[ok], return_counts=True)
+        f, d = keys // max(n, 1), keys % max(n, 1)
+        df = np.bincount(f, minlength=NOTES_DIM)
+        self.idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+        w = np.log1p(cnt).astype(np.float32) * self.idf[f]
+        norms = np.sqrt(np.bincount(d, weights=w * w, minlength=n))
+        self.post_w = (w / np.maximum(norms[d], 1e-9)).astype(np.float16)
+        self.post_doc = d.astype(np.uint32)
+        self.ptr = np.concatenate(([0], np.cumsum(df)))
+        self.ids = np.fromiter((r[0] for r in rows), np.int64, n)
+        self.delta = []  # (id, корзины, веса) заметок, добавленных после сборки
+        self.last_id = int(self.ids[-1]) if n else 0
+        return self
+
+    def add(self, nid: int, cat: str, question: str, answer: str):
+        if nid <= self.last_id:
+            return
+        f, w = _note_weights(_note_feats(_note_text(cat, question, answer)), self.idf)
+        self.delta.append((nid, f.astype(np.uint16), w.astype(np.float16)))
+        self.last_id = nid
+
+    def nbytes(self) -> int:
+        return (self.ids.nbytes + self.idf.nbytes + self.ptr.nbytes + self.post_doc.nbytes
+                + self.post_w.nbytes + sum(f.nbytes + w.nbytes + 64 for _, f, w in self.delta))
+
+    def top(self, text: str, k: int = 3):
+        """-> [(sim, id)] по убыванию сходства"""
+        qf, qw = _note_weights(_note_feats(text), self.idf)
+        if not len(qf):
+            return []
+        hits = []
+        if self.n:
+            lens = self.ptr[qf + 1] - self.ptr[qf]
+            total = int(lens.sum())
+            if total:
+                # индексы всех элементов нужных списков одним массивом
+                sel = np.arange(total) + np.repeat(self.ptr[qf] - (np.cumsum(lens) - lens), lens)
+                scores = np.bincount(self.post_doc[sel], minlength=self.n,
+                                     weights=self.post_w[sel].astype(np.float32) * np.repeat(qw, lens))
+                kk = min(k, self.n)
+                best = np.argpartition(-scores, kk - 1)[:kk]
+                hits = [(float(scores[i]), int(self.ids[i])) for i in best]
+        if self.delta:
+            qd = np.zeros(NOTES_DIM, np.float32)
+            qd[qf] = qw
+            hits += [(float(qd[f] @ w.astype(np.float32)), nid) for nid, f, w in self.delta]
+        hits.sort(reverse=True)
+        return [h for h in hits[:k] if h[0] >= NOTES_MIN_SIM]
+
+# индексы держим только для недавно активных пользователей, в пределах ~25% бюджета
+_note_index = _TTLCache("notes", maxsize=_budget("NOTES_CACHE_USERS", 0.25, 256 * 1024),
+                        ttl=6 * 3600, weigh=lambda idx: idx.nbytes(),
+                        maxweight=_budget("NOTES_CACHE_BYTES", 0.25, 1, floor=1024 * 1024))
+_note_building = {}  # uid -> задача сборки, чтобы не собирать один индекс дважды
+
+def _notes_build_sync(uid: int) -> _NoteIndex:
+    conn = _thread_db()
+    try:
+        return _NoteIndex.build(conn.execute(NOTES_SQL, (uid, 0)).fetchall())
+    finally:
+        conn.close()
+
+async def _notes_build(uid: int) -> _NoteIndex:
+    if DB_FILE:
+        return await asyncio.to_thread(_notes_build_sync, uid)
+    cur.execute(NOTES_SQL, (uid, 0))
+    return await asyncio.to_thread(_NoteIndex.build, cur.fetchall())
+
+async def _notes_index(uid: int) -> _NoteIndex:
+    idx = _note_index.get(uid)
+    if idx is not None:
+        return idx
+    task = _note_building.get(uid)
+    if task is None:
+        task = _note_building[uid] = asyncio.ensure_future(_notes_build(uid))
+        task.add_done_callback(lambda _t, uid=uid: _note_building.pop(uid, None))
+    idx = await asyncio.shield(task)
+    # заметки, сохранённые пока индекс собирался
+    cur.execute(NOTES_SQL, (uid, idx.last_id))
+    for row in cur.fetchall():
+        idx.add(*row)
+    _note_index[uid] = idx
+    return idx
+
+def _notes_added(uid: int, nid: int, cat: str, question: str, answer: str):
+    # индекс ещё не построен — соберётся из БД при первом запросе
+    idx = _note_index.get(uid)
+    if idx is None:
+        return
+    if len(idx.delta) >= NOTES_DELTA_MAX:
+        _note_index.pop(uid)
+        return
+    idx.add(nid, cat, question, answer)
+    _note_index[uid] = idx  # пересчитать вес
+
+async def _notes_similar(uid: int, text: str, k: int = 3):
+    """-> [(sim, id, category, question, answer)]"""
+    if np is None or not (text or "").strip():
+        return []
+    try:
+        hits = (await _notes_index(uid)).top(text, k)
+    except Exception as e:
+        print("[notes] err", e)
+        return []
+    if not hits:
+        return []
+    cur.execute(f"SELECT id, category, question, answer FROM qanswers WHERE id IN ({','.join('?' * len(hits))})",
+                [nid for _, nid in hits])
+    rows = {r[0]: r[1:] for r in cur.fetchall()}
+    return [(sim, nid, *rows[nid]) for sim, nid in hits if nid in rows]
+
+async def _ai_prompt(uid: int, text: str) -> str:
+    cur.execute("SELECT role, content FROM chatlog WHERE user_id=? ORDER BY id DESC LIMIT 8", (uid,))
+    rows = list(reversed(cur.fetchall()))
+    convo = ""
+    for r,c in rows[-6:]:
+        who = "Ты" if r=="assistant" else "Я"
+        convo += f"{who}: {c[-400:]}\n"
+    prompt = f"{convo}\nЯ: {text}\nОтветь как обычно, учитывая контекст выше."
+    notes = await _notes_similar(uid, text)
+    if notes:
+        mem = "".join(f"- {_note_title(c, q)} — {a[:300]}\n" for _, _, c, q, a in notes)
+        prompt = f"Мои заметки, которые могут пригодиться:\n{mem}\n{prompt}"
+    return prompt
+
+async def _ai_reply(uid: int, text: str, context: bool = True) -> str:
+    """Как _ai_answer_with_ctx, но ошибки ИИ пробрасывает наружу.
+    context=False — голый запрос без чата и заметок (сводки вроде дайджеста)."""
     if llm_short_reply is None:
         return "Я сейчас без ключа ИИ, но уже не повторяю дословно: " + (text[:200] if text else "")
+    prompt = await _ai_prompt(uid, text) if context else text
+    # запрос к LLM блокирующий — уводим в поток, чтобы не держать event loop
+    return await asyncio.to_thread(llm_short_reply, prompt)
+
+async def _ai_answer_with_ctx(uid: int, text: str) -> str:
     try:
-        cur.execute("SELECT role, content FROM chatlog WHERE user_id=? ORDER BY id DESC LIMIT 8", (uid,))
-        rows = list(reversed(cur.fetchall()))
-        convo = ""
-        for r,c in rows[-6:]:
-            who = "Ты" if r=="assistant" else "Я"
-            convo += f"{who}: {c[-400:]}\n"
-        prompt = f"{convo}\nЯ: {text}\nОтветь как обычно, учитывая контекст выше."
-        return llm_short_reply(prompt)
+        return await _ai_reply(uid, text)
     except Exception as e:
         return f"Не смогла позвать ИИ: {e}"
 
+# Upstreams: у каждого внешнего провайдера свой circuit breaker и история задержек.
+# Запрос уходит самому быстрому здоровому провайдеру; если тот не ответил за свой
+# p95 — параллельно стартует следующий (hedging), побеждает первый успешный ответ.
+# Отказом считаются только сеть, таймаут и 5xx; «город не найден» — нормальный ответ.
+UPSTREAM_TIMEOUT = 10
+BREAKER_FAILS = int(os.getenv("BREAKER_FAILS", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "60"))
+HEDGE_DEFAULT = 2.0  # сек до подстраховки, пока нет статистики
+HEDGE_MIN = 0.3
+
+class _Upstream:
+    __slots__ = ("name", "fails", "open_until", "lat")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.fails = 0
+        self.open_until = 0.0
+        self.lat = deque(maxlen=50)
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def _pct(self, q: float) -> float:
+        if len(self.lat) < 5:
+            return HEDGE_DEFAULT
+        xs = sorted(self.lat)
+        return xs[int(q * (len(xs) - 1))]
+
+    def typical(self) -> float:
+        return self._pct(0.5)
+
+    def p95(self) -> float:
+        return max(HEDGE_MIN, self._pct(0.95))
+
+    def ok(self, dt: float):
+        self.fails = 0
+        self.lat.append(dt)
+
+    def waited(self, dt: float):
+        # ответа не дождались: время ожидания — нижняя граница задержки,
+        # иначе медленные ответы, проигравшие хеджу, не попадают в p95
+        self.lat.append(dt)
+
+    def fail(self):
+        self.fails += 1
+        if self.fails >= BREAKER_FAILS:
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+            print(f"[{self.name}] circuit open for {BREAKER_COOLDOWN:.0f}s")
+
+async def _upstream_call(up: _Upstream, fn):
+    t0 = time.monotonic()
+    try:
+        res = await asyncio.wait_for(fn(), UPSTREAM_TIMEOUT)
+    except asyncio.CancelledError:
+        up.waited(time.monotonic() - t0)
+        raise
+    except asyncio.TimeoutError:
+        print(f"[{up.name}] timeout")
+        up.waited(time.monotonic() - t0)
+        up.fail()
+        return None
+    except Exception as e:
+        print(f"[{up.name}] err", e)
+        up.fail()
+        return None
+    # пустой результат — провайдер жив и ответил «не найдено»
+    up.ok(time.monotonic() - t0)
+    return res
+
+async def _hedged(calls):
+    """calls: [(upstream, async fn)] -> первый непустой результат;
+    пустой, если провайдеры ответили «не найдено»; None, если все упали"""
+    calls = [c for c in calls if c[0].healthy()] or calls
+    queue = sorted(calls, key=lambda c: c[0].typical())
+    tasks = set()
+    empty = None
+    try:
+        while queue or tasks:
+            wait = None
+            if queue:
+                up, fn = queue.pop(0)
+                tasks.add(asyncio.create_task(_upstream_call(up, fn)))
+                if queue:
+                    wait = up.p95()
+            done, tasks = await asyncio.wait(tasks, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                res = t.result()
+                if res:
+                    return res
+                if res is not None:
+                    empty = res
+    finally:
+        for t in tasks:
+            t.cancel()
+    return empty
+
+UP_OWM = _Upstream("owm")
+UP_OPEN_METEO = _Upstream("open-meteo")
+UP_FX_HOST = _Upstream("exchangerate.host")
+UP_FX_ERAPI = _Upstream("open.er-api.com")
+
 # Weather helpers
+async def _get_json(url: str):
+    """JSON ответа или None, если провайдер ответил 4xx; сеть, 5xx и 429 — исключение"""
+    async with ClientSession() as s:
+        async with s.get(url, timeout=10) as r:
+            if r.status >= 500 or r.status == 429:
+                r.raise_for_status()
+            if r.status >= 400:
+                return None
+            return await r.json()
+
 async def _geocode_city(city: str):
     url = f"https://geocoding-api.open-meteo.com/v1/search?count=1&language=ru&name={city}"
-    try:
-        async with ClientSession() as s:
-            async with s.get(url, timeout=10) as r:
-                j = await r.json()
-        res = (j.get("results") or [])[0]
-        return res["latitude"], res["longitude"]
-    except Exception as e:
-        print("[geo] err", e)
+    j = await _get_json(url) or {}
+    res = (j.get("results") or [None])[0]
+    if not res:
         return None, None
+    return res["latitude"], res["longitude"]
 
 async def _weather_by_coords(lat, lon):
     url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,weather_code,wind_speed_10m"
-    try:
-        async with ClientSession() as s:
-            async with s.get(url, timeout=10) as r:
-                j = await r.json()
-        return j.get("current", {})
-    except Exception as e:
-        print("[weather] err", e)
+    cur_w = (await _get_json(url) or {}).get("current")
+    if not cur_w:
+        raise RuntimeError("no current weather in response")
+    return cur_w
+
+async def _weather_owm(city: str):
+    url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={OWM_KEY}&units=metric&lang=ru"
+    j = await _get_json(url) or {}
+    t = (j.get("main") or {}).get("temp")
+    w = (j.get("wind") or {}).get("speed")
+    if t is None:
         return {}
+    return {"temperature_2m": t, "wind_speed_10m": w}
+
+async def _weather_open_meteo(city: str):
+    lat, lon = await _geocode_city(city)
+    if lat is None: return {}
+    return await _weather_by_coords(lat, lon)
 
 async def _weather_by_city(city: str):
+    """данные погоды; {} — город не найден, None — провайдеры недоступны"""
+    calls = [(UP_OPEN_METEO, lambda: _weather_open_meteo(city))]
     if OWM_KEY:
-        url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={OWM_KEY}&units=metric&lang=ru"
+        calls.insert(0, (UP_OWM, lambda: _weather_owm(city)))
+    return await _hedged(calls)
+
+# Кэш погоды по городам. Фоновая задача заранее обновляет города из prefs,
+# так что кнопка «🌊 Погода» обычно отвечает из памяти.
+WEATHER_TTL = int(os.getenv("WEATHER_TTL", "1800"))
+WEATHER_PREFETCH_EVERY = int(os.getenv("WEATHER_PREFETCH_EVERY", "600"))
+WEATHER_PREFETCH_BATCH = int(os.getenv("WEATHER_PREFETCH_BATCH", "5"))
+WEATHER_PREFETCH_MAX = int(os.getenv("WEATHER_PREFETCH_MAX", "100"))  # городов за цикл
+WEATHER_PREFETCH_PAUSE = 1.0  # сек между пачками, чтобы не упереться в лимиты API
+WEATHER_MISSING_TTL = int(os.getenv("WEATHER_MISSING_TTL", "900"))  # сколько помнить «город не найден»
+
+_weather_cache = _TTLCache("weather", maxsize=_budget("WEATHER_CACHE_CITIES", 0.01, 1024), ttl=WEATHER_TTL)
+# обращения за сутки: ключ -> (число, как город написан)
+_weather_hits = _TTLCache("weather_hits", maxsize=_budget("WEATHER_CACHE_CITIES", 0.01, 1024), ttl=24 * 3600)
+# города, которых провайдеры не знают (опечатки): не спрашиваем их снова каждый раз
+_weather_missing = _TTLCache("weather_missing", maxsize=_budget("WEATHER_CACHE_CITIES", 0.01, 1024), ttl=WEATHER_MISSING_TTL)
+
+def _city_key(city: str) -> str:
+    return " ".join(city.split()).lower()
+
+def _weather_hit(key: str, city: str):
+    hits, _ = _weather_hits.get(key, (0, city))
+    _weather_hits[key] = (hits + 1, city)
+
+async def _weather_cached(city: str):
+    key = _city_key(city)
+    item = _weather_cache.get(key)
+    if item:
+        _weather_hit(key, city)
+        return item[1]
+    if key in _weather_missing:
+        return {}
+    data = await _weather_by_city(city)
+    if data:
+        _weather_cache[key] = (time.time(), data)
+        # в предзагрузку попадают только города, по которым погода нашлась
+        _weather_hit(key, city)
+    elif data is not None:
+        _weather_missing[key] = True
+    return data or {}
+
+def _weather_demand() -> dict:
+    """ключ города -> [приоритет, название]: сколько пользователей ссылается + недавние запросы"""
+    demand = {}
+    cur.execute("""SELECT c, COUNT(*) FROM (SELECT city AS c FROM prefs UNION ALL SELECT partner_city FROM prefs)
+                   WHERE c IS NOT NULL GROUP BY c""")
+    rows = cur.fetchall()
+    # у пользователей без строки в prefs — города по умолчанию
+    cur.execute("SELECT COUNT(*) FROM users WHERE user_id NOT IN (SELECT user_id FROM prefs)")
+    no_prefs = cur.fetchone()[0]
+    if no_prefs:
+        rows += [("Moscow", no_prefs), ("Zibo", no_prefs)]
+    for city, n in rows:
+        if city.strip():
+            demand.setdefault(_city_key(city), [0, city.strip()])[0] += n
+    for key, (hits, city) in _weather_hits.items():
+        demand.setdefault(key, [0, city])[0] += 2 * hits
+    return demand
+
+async def _weather_prefetch():
+    now = time.time()
+    due = []
+    for key, (score, city) in _weather_demand().items():
+        if key in _weather_missing:
+            continue
+        item = _weather_cache.get(key)
+        if not item or now - item[0] >= WEATHER_PREFETCH_EVERY:
+            due.append((score, key, city))
+    due.sort(reverse=True)
+
+    async def one(key, city):
+        data = await _weather_by_city(city)
+        if data:
+            _weather_cache[key] = (time.time(), data)
+        elif data is not None:
+            _weather_missing[key] = True
+
+    due = due[:WEATHER_PREFETCH_MAX]
+    for i in range(0, len(due), WEATHER_PREFETCH_BATCH):
+        if i:
+            await asyncio.sleep(WEATHER_PREFETCH_PAUSE)
+        await asyncio.gather(*(one(key, city) for _, key, city in due[i:i + WEATHER_PREFETCH_BATCH]))
+
+async def _weather_loop():
+    while True:
         try:
-            async with ClientSession() as s:
-                async with s.get(url, timeout=10) as r:
-                    j = await r.json()
-            t = (j.get("main") or {}).get("temp")
-            w = (j.get("wind") or {}).get("speed")
-            if t is not None:
-                return {"temperature_2m": t, "wind_speed_10m": w}
+            await _weather_prefetch()
+            await asyncio.sleep(WEATHER_PREFETCH_EVERY)
+        except asyncio.CancelledError:
+            break
         except Exception as e:
-            print("[owm] err", e)
-    lat, lon = await _geocode_city(city)
-    if not lat: return {}
-    return await _weather_by_coords(lat, lon)
+            print("[weather loop]", e)
+            await asyncio.sleep(WEATHER_PREFETCH_EVERY)
 
 # FX helpers
-FX_CACHE = {"ts": 0, "data": {}}
+FX_CACHE = {"ts": 0, "data": {}, "src": ""}
 FX_SYMBOLS = ["RUB","CNY","USD"]
 
 def _fmt_amount(x: float) -> str:
@@ -232,72 +778,93 @@ def _norm_ccy(s: str) -> str:
     aliases = {"YUAN":"CNY","RMB":"CNY","YUANS":"CNY","RUBLES":"RUB","RUR":"RUB","RUBLE":"RUB","DOLLAR":"USD","DOLLARS":"USD"}
     return aliases.get(s, s)
 
+async def _rates_json(url: str, src: str):
+    async with ClientSession() as s:
+        async with s.get(url, timeout=10) as r:
+            j = await r.json()
+    rates = j.get("rates") or {}
+    if not rates.get("USD") or not rates.get("CNY"):
+        raise RuntimeError("no USD/CNY in response")
+    return {"USD": rates["USD"], "CNY": rates["CNY"], "src": src}
+
 async def _fetch_rates():
     # Cache 10 minutes
     if time.time() - FX_CACHE["ts"] < 600 and FX_CACHE["data"]:
         return FX_CACHE["data"]
-    url = "https://api.exchangerate.host/latest?base=RUB&symbols=USD,CNY"
-    try:
-        async with ClientSession() as s:
-            async with s.get(url, timeout=10) as r:
-                j = await r.json()
-                rates = j.get("rates", {})
-                data = {
-                    "RUB": {"RUB": 1.0, "USD": rates.get("USD"), "CNY": rates.get("CNY")},
-                }
-                usd_rub = 1.0 / data["RUB"]["USD"] if data["RUB"]["USD"] else None
-                cny_rub = 1.0 / data["RUB"]["CNY"] if data["RUB"]["CNY"] else None
-                data["USD"] = {"USD":1.0, "RUB": usd_rub, "CNY": (cny_rub*data["RUB"]["USD"]) if (cny_rub and data["RUB"]["USD"]) else None}
-                data["CNY"] = {"CNY":1.0, "RUB": cny_rub, "USD": (usd_rub/data['RUB']['CNY']) if (usd_rub and data['RUB']['CNY']) else None}
-                FX_CACHE["ts"] = time.time()
-                FX_CACHE["data"] = data
-                return data
-    except Exception as e:
-        print("[FX] error:", e)
-    return FX_CACHE["data"] or {}
+    rates = await _hedged([
+        (UP_FX_HOST, lambda: _rates_json("https://api.exchangerate.host/latest?base=RUB&symbols=USD,CNY", "exchangerate.host")),
+        (UP_FX_ERAPI, lambda: _rates_json("https://open.er-api.com/v6/latest/RUB", "open.er-api.com")),
+    ])
+    if not rates:
+        return FX_CACHE["data"] or {}
+    data = {
+        "RUB": {"RUB": 1.0, "USD": rates["USD"], "CNY": rates["CNY"]},
+    }
+    usd_rub = 1.0 / data["RUB"]["USD"]
+    cny_rub = 1.0 / data["RUB"]["CNY"]
+    data["USD"] = {"USD":1.0, "RUB": usd_rub, "CNY": cny_rub*data["RUB"]["USD"]}
+    data["CNY"] = {"CNY":1.0, "RUB": cny_rub, "USD": usd_rub/data["RUB"]["CNY"]}
+    FX_CACHE["ts"] = time.time()
+    FX_CACHE["data"] = data
+    FX_CACHE["src"] = rates["src"]
+    return data
 
 # ── UI ─────────────────────────────────────────────────────────────────────
+@lru_cache(maxsize=None)
 def main_keyboard():
-    return ReplyKeyboardMarkup(
+    # один объект на процесс: типы aiogram frozen, JSON готовит _PreparedSession
+    return _prepare(ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="💙 Настроение"), KeyboardButton(text="💌 Вопросы")],
             [KeyboardButton(text="🕒 Время"), KeyboardButton(text="🌊 Погода")],
             [KeyboardButton(text="💱 Курсы"), KeyboardButton(text="📅 Недельный дайджест")]
         ],
         resize_keyboard=True
-    )
+    ))
+
+START_TEXT = "Привет! Я рядом. Жми кнопки в меню ниже. /help — список команд"
+HELP_TEXT = (
+    "Навигация кнопками или командами:\n"
+    "💙 /mood 7 заметка — настроение\n"
+    "💌 /qadd <cat> вопрос = ответ • /q [cat] поиск • /q_history\n"
+    "🕒 /menu — время для TZ/Москва/Шанхай\n"
+    "🌊 /weather [город] — погода (OWM/Open-Meteo)\n"
+    "💱 /fx [100 usd to rub] — курсы/конвертер\n"
+    "📅 /digest — недельный дайджест\n"
+    "📥 /import — импорт настроений и заметок из CSV/JSONL\n"
+    "/style • /flirt • /nsfw • /setpetname • /settz • /setcity • /setpartner"
+)
+
+@lru_cache(maxsize=512)
+def _clock_at(tz: str, minute: int) -> str:
+    try:
+        return f"{datetime.fromtimestamp(minute * 60, ZoneInfo(tz)):%H:%M}"
+    except Exception:
+        return f"{datetime.utcfromtimestamp(minute * 60):%H:%M}"
+
+def _clock(tz: str) -> str:
+    """HH:MM в часовом поясе; форматируется раз в минуту на TZ."""
+    return _clock_at(tz, int(time.time() // 60))
 
 # ── BASIC HANDLERS ─────────────────────────────────────────────────────────
 @dp.message(Command("start"))
 async def cmd_start(m: types.Message):
     uid = m.from_user.id
     get_user(uid); get_prefs(uid)
-    await m.answer("Привет! Я рядом. Жми кнопки в меню ниже. /help — список команд", reply_markup=main_keyboard())
+    await m.answer(START_TEXT, reply_markup=main_keyboard())
 
 @dp.message(Command("help"))
 async def cmd_help(m: types.Message):
-    await m.answer(
-        "Навигация кнопками или командами:\n"
-        "💙 /mood 7 заметка — настроение\n"
-        "💌 /qadd <cat> вопрос = ответ • /q [cat] поиск • /q_history\n"
-        "🕒 /menu — время для TZ/Москва/Шанхай\n"
-        "🌊 /weather [город] — погода (OWM/Open-Meteo)\n"
-        "💱 /fx [100 usd to rub] — курсы/конвертер\n"
-        "📅 /digest — недельный дайджест\n"
-        "/style • /flirt • /nsfw • /setpetname • /settz • /setcity • /setpartner"
-    , reply_markup=main_keyboard())
+    await m.answer(HELP_TEXT, reply_markup=main_keyboard())
 
 @dp.message(Command("menu"))
 async def cmd_menu(m: types.Message):
     uid = m.from_user.id
     _, tz, pet, _ = get_user(uid)
     pf = get_prefs_dict(uid)
-    now_me = _now_in_tz(tz)
-    msk = _now_in_tz("Europe/Moscow")
-    sha = _now_in_tz("Asia/Shanghai")
     await m.answer(
-        f"⏱ Твоё время ({tz}): <b>{now_me:%H:%M}</b>\n"
-        f"🇷🇺 Москва: <b>{msk:%H:%M}</b> • 🇨🇳 Шанхай/Цзыбо: <b>{sha:%H:%M}</b>\n"
+        f"⏱ Твоё время ({tz}): <b>{_clock(tz)}</b>\n"
+        f"🇷🇺 Москва: <b>{_clock('Europe/Moscow')}</b> • 🇨🇳 Шанхай/Цзыбо: <b>{_clock('Asia/Shanghai')}</b>\n"
         f"🏙 Город: {pf['city']} • Партнёр: {pf['partner_city']}\n"
         f"Обращаться: {pet}",
         reply_markup=main_keyboard()
@@ -463,6 +1030,7 @@ async def cmd_qadd(m: types.Message):
     cur.execute("INSERT INTO qanswers(user_id, category, question, answer) VALUES(?,?,?,?)",
                 (uid, cat.strip(), question.strip(), answer))
     db.commit()
+    _notes_added(uid, cur.lastrowid, cat.strip(), question.strip(), answer)
     await m.answer("Сохранила.")
 
 @dp.message(Command("q"))
@@ -476,15 +1044,22 @@ async def cmd_q(m: types.Message):
     else:
         cat = parts[1]; q = parts[2]
     if cat:
-        cur.execute("SELECT question,answer FROM qanswers WHERE user_id=? AND category LIKE ? AND (question LIKE ? OR answer LIKE ?) ORDER BY ts DESC LIMIT 6",
+        cur.execute("SELECT id,question,answer FROM qanswers WHERE user_id=? AND category LIKE ? AND (question LIKE ? OR answer LIKE ?) ORDER BY ts DESC LIMIT 6",
                     (uid, f"%{cat}%", f"%{q}%", f"%{q}%"))
     else:
-        cur.execute("SELECT question,answer FROM qanswers WHERE user_id=? AND (question LIKE ? OR answer LIKE ?) ORDER BY ts DESC LIMIT 6",
+        cur.execute("SELECT id,question,answer FROM qanswers WHERE user_id=? AND (question LIKE ? OR answer LIKE ?) ORDER BY ts DESC LIMIT 6",
                     (uid, f"%{q}%", f"%{q}%"))
     rows = cur.fetchall()
-    if not rows:
+    shown = {r[0] for r in rows}
+    similar = [s for s in await _notes_similar(uid, q, k=6)
+               if s[1] not in shown and (not cat or cat.lower() in (s[2] or "").lower())][:3]
+    if not rows and not similar:
         return await m.answer("Ничего не нашла.")
-    out = "\n".join([f"• <i>{r[0]}</i> — <b>{r[1]}</b>" for r in rows])
+    out = "\n".join([f"• <i>{r[1]}</i> — <b>{r[2]}</b>" for r in rows])
+    if similar:
+        head = "Может, ты про это:" if not rows else "Ещё похожее:"
+        tail = "\n".join([f"• <i>{_note_title(s[2], s[3])}</i> — <b>{s[4]}</b>" for s in similar])
+        out = f"{out}\n\n{head}\n{tail}" if out else f"Дословно не нашла. {head}\n{tail}"
     await m.answer(out)
 
 @dp.message(Command("q_history"))
@@ -497,6 +1072,194 @@ async def cmd_q_history(m: types.Message):
     out = "\n".join([f"• [{r[0]}] {r[1]} — <b>{r[2]}</b> ({r[3]})" for r in rows])
     await m.answer(out)
 
+# ── BULK IMPORT ────────────────────────────────────────────────────────────
+# Перенос из ноутбука: CSV/JSONL с настроениями и заметками.
+# Строки читаются потоком и пишутся пачками executemany в одной транзакции.
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "5000"))
+IMPORT_MAX_MB = int(os.getenv("IMPORT_MAX_MB", "100"))
+TG_DOWNLOAD_MAX = 20 * 1024 * 1024  # лимит getFile в Bot API
+IMPORT_EXTS = (".csv", ".jsonl", ".ndjson", ".json")
+
+def _import_format(name: str, head: bytes) -> str:
+    n = (name or "").lower()
+    head = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    if n.endswith(".csv"):
+        return "csv"
+    # обычный JSON-массив построчно не читается — иначе все строки ушли бы в «пропущено»
+    if head.startswith(b"["):
+        raise ValueError("это JSON-массив, а нужен JSONL — один объект на строку (см. /import)")
+    if n.endswith((".jsonl", ".ndjson", ".json")) or head.startswith(b"{"):
+        return "jsonl"
+    return "csv"
+
+def _import_records(fh, fmt: str):
+    if fmt == "csv":
+        reader = csv.DictReader(fh)
+        while True:
+            # битая строка (например, слишком длинное поле) — пропуск, а не отмена файла
+            try:
+                yield next(reader)
+            except StopIteration:
+                return
+            except csv.Error:
+                yield None
+    for line in fh:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            rec = None
+        yield rec if isinstance(rec, dict) else None
+
+def _import_row(rec):
+    """-> ("mood", (day, score, note)) | ("qa", (cat, question, answer)) | None"""
+    if not rec:
+        return None
+    rec = {str(k).strip().lower(): v for k, v in rec.items() if k is not None}
+    kind = str(rec.get("type") or rec.get("kind") or "").strip().lower()
+    if not kind:
+        kind = "mood" if rec.get("score") not in (None, "") else "qa"
+    if kind == "mood":
+        try:
+            score = int(float(str(rec.get("score")).strip().replace(",", ".")))
+            day = date.fromisoformat(str(rec.get("day") or rec.get("date") or "").strip()[:10]).isoformat()
+        except (ValueError, OverflowError):
+            return None
+        if not 0 <= score <= 10:
+            return None
+        return "mood", (day, score, str(rec.get("note") or "").strip()[:4000])
+    if kind in ("qa", "note", "qanswer"):
+        answer = str(rec.get("answer") or "").strip()
+        if not answer:
+            return None
+        cat = str(rec.get("category") or rec.get("cat") or "").strip() or "import"
+        question = str(rec.get("question") or "").strip() or "import"
+        return "qa", (cat, question, answer[:4000])
+    return None
+
+def _bulk_import(conn, uid: int, fh, fmt: str):
+    """-> (записано, пропущено, ошибка или None)"""
+    moods, qas = [], []
+    done = bad = 0
+
+    # транзакция на пачку: блокировка записи держится недолго,
+    # и запросы бота не ждут весь файл
+    def flush():
+        nonlocal done
+        with conn:
+            if moods:
+                conn.executemany("INSERT INTO moods(user_id, day, score, note) VALUES(?,?,?,?)", moods)
+            if qas:
+                conn.executemany("INSERT INTO qanswers(user_id, category, question, answer) VALUES(?,?,?,?)", qas)
+        done += len(moods) + len(qas)
+        moods.clear()
+        qas.clear()
+
+    try:
+        for rec in _import_records(fh, fmt):
+            row = _import_row(rec)
+            if row is None:
+                bad += 1
+                continue
+            kind, vals = row
+            (moods if kind == "mood" else qas).append((uid, *vals))
+            if len(moods) + len(qas) >= IMPORT_BATCH:
+                flush()
+        flush()
+    except Exception as e:
+        # уже записанные пачки остаются, текущая откатывается
+        return done, bad, str(e)
+    return done, bad, None
+
+def _run_import(uid: int, raw, name: str):
+    head = raw.read(64)
+    raw.seek(0)
+    fmt = _import_format(name, head)
+    fh = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+    conn = _thread_db()
+    try:
+        return _bulk_import(conn or db, uid, fh, fmt)
+    finally:
+        fh.detach()
+        if conn is not None:
+            conn.close()
+
+async def _import(uid: int, raw, name: str):
+    if DB_FILE:
+        res = await asyncio.to_thread(_run_import, uid, raw, name)
+    else:
+        # in-memory БД видна только основному соединению
+        res = _run_import(uid, raw, name)
+    # индекс заметок пересоберётся один раз при следующем запросе
+    _note_index.pop(uid, None)
+    return res
+
+@dp.message(Command("import"))
+async def cmd_import(m: types.Message):
+    await m.answer(
+        "Пришли файл .csv или .jsonl — импортирую настроения и заметки.\n"
+        "CSV: колонки <code>type,day,score,note,category,question,answer</code>\n"
+        "JSONL: <code>{\"type\":\"mood\",\"day\":\"2024-05-01\",\"score\":7,\"note\":\"...\"}</code>\n"
+        "<code>{\"type\":\"qa\",\"category\":\"thermo\",\"question\":\"...\",\"answer\":\"...\"}</code>"
+    )
+
+@dp.message(F.document)
+async def doc_import(m: types.Message):
+    doc = m.document
+    if not (doc.file_name or "").lower().endswith(IMPORT_EXTS):
+        return await m.answer("Для импорта нужен .csv или .jsonl. Формат: /import")
+    if (doc.file_size or 0) > TG_DOWNLOAD_MAX:
+        return await m.answer("Файл больше 20 МБ — раздели его на части.")
+    try:
+        raw = await bot.download(doc)
+        ok, bad, err = await _import(m.from_user.id, raw, doc.file_name)
+    except Exception as e:
+        print("[import] err", e)
+        return await m.answer(f"Не получилось импортировать: {e}")
+    text = f"Импортировала {ok} записей." + (f" Пропустила {bad} строк с ошибками." if bad else "")
+    if err:
+        print("[import] err", err)
+        text += f"\nДальше файл прочитать не вышло: {err}"
+    await m.answer(text)
+
+def _admin_ok(request: web.Request) -> bool:
+    if not ADMIN_TOKEN:
+        return False
+    got = request.headers.get("X-Admin-Token", "")
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        got = auth[7:]
+    return hmac.compare_digest(got.encode(), ADMIN_TOKEN.encode())
+
+async def import_handler(request: web.Request):
+    if not _admin_ok(request):
+        return web.json_response({"ok": False, "error": "forbidden"}, status=403)
+    try:
+        uid = int(request.match_info["uid"])
+    except ValueError:
+        return web.json_response({"ok": False, "error": "bad user id"}, status=400)
+    fmt = request.query.get("format", "")
+    if fmt not in ("", "csv", "jsonl"):
+        return web.json_response({"ok": False, "error": "format must be csv or jsonl"}, status=400)
+    limit = IMPORT_MAX_MB * 1024 * 1024
+    size = 0
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as raw:
+        async for chunk in request.content.iter_chunked(64 * 1024):
+            size += len(chunk)
+            if size > limit:
+                return web.json_response({"ok": False, "error": "too large"}, status=413)
+            raw.write(chunk)
+        raw.seek(0)
+        try:
+            ok, bad, err = await _import(uid, raw, f"upload.{fmt}" if fmt else "")
+        except Exception as e:
+            return web.json_response({"ok": False, "error": str(e)}, status=400)
+    if err:
+        return web.json_response({"ok": False, "imported": ok, "skipped": bad, "error": err}, status=400)
+    return web.json_response({"ok": True, "imported": ok, "skipped": bad})
+
 # ── WEATHER ────────────────────────────────────────────────────────────────
 @dp.message(Command("weather"))
 async def cmd_weather(m: types.Message):
@@ -504,7 +1267,7 @@ async def cmd_weather(m: types.Message):
     pf = get_prefs_dict(uid)
     parts = (m.text or "").split(maxsplit=1)
     city = (parts[1].strip() if len(parts)>1 else pf["city"]) or pf["city"]
-    cur_w = await _weather_by_city(city)
+    cur_w = await _weather_cached(city)
     if not cur_w: return await m.answer("Нет данных по погоде.")
     t = cur_w.get("temperature_2m"); w = cur_w.get("wind_speed_10m"); 
     await m.answer(f"Погода в {city}: {t}°C, ветер {w} м/с.")
@@ -520,7 +1283,7 @@ async def cmd_fx(m: types.Message):
         rub_usd = data["RUB"]["USD"]; rub_cny = data["RUB"]["CNY"]
         usd_rub = data["USD"]["RUB"]; cny_rub = data["CNY"]["RUB"]
         return await m.answer(
-            "Курсы (exchangerate.host):\n"
+            f"Курсы ({FX_CACHE['src'] or 'кэш'}):\n"
             f"1 USD ≈ <b>{_fmt_amount(usd_rub)} RUB</b>\n"
             f"1 CNY ≈ <b>{_fmt_amount(cny_rub)} RUB</b>\n"
             f"1 RUB ≈ {_fmt_amount(rub_usd)} USD • {_fmt_amount(rub_cny)} CNY"
@@ -570,7 +1333,7 @@ async def btn_weather(m: types.Message):
     for city in list(dict.fromkeys([pf["city"], pf["partner_city"]])):
         if not city: 
             continue
-        cur_w = await _weather_by_city(city)
+        cur_w = await _weather_cached(city)
         if cur_w:
             t = cur_w.get("temperature_2m"); w = cur_w.get("wind_speed_10m")
             txts.append(f"{city}: {t}°C, ветер {w} м/с")
@@ -604,7 +1367,8 @@ QUESTIONS = {
 async def btn_questions(m: types.Message):
     await m.answer("Выбери тему: легкие / глубже / флирт. Напиши ответ одним сообщением — я сохраню.")
 
-_last_question_category = {}
+# выбранная тема ждёт ответа не дольше часа
+_last_question_category = _TTLCache("questions", maxsize=_budget("QUESTION_PENDING_MAX", 0.01, 256), ttl=3600)
 
 @dp.message(F.text.lower().in_(["легкие","глубже","флирт"]))
 async def pick_category(m: types.Message):
@@ -616,23 +1380,40 @@ async def pick_category(m: types.Message):
 @dp.message(F.text & F.text.lower().not_in(["легкие","глубже","флирт"]) & ~F.text.startswith("/"))
 async def capture_answer_after_question(m: types.Message):
     uid = m.from_user.id
-    if uid in _last_question_category:
-        cat = _last_question_category.pop(uid)
+    cat = _last_question_category.pop(uid)
+    if cat:
         cur.execute("INSERT INTO qanswers(user_id, category, question, answer) VALUES(?,?,?,?)",
                     (uid, cat, "user-flow", (m.text or '').strip()))
         db.commit()
+        _notes_added(uid, cur.lastrowid, cat, "user-flow", (m.text or '').strip())
         return await m.answer("Сохранила 💌. Посмотреть: /q "+cat)
 
 # ── WEEKLY DIGEST ──────────────────────────────────────────────────────────
-@dp.message(Command("digest"))
-@dp.message(F.text == "📅 Недельный дайджест")
-async def cmd_digest(m: types.Message):
-    uid = m.from_user.id
-    cur.execute("SELECT day, AVG(score) FROM moods WHERE user_id=? GROUP BY day ORDER BY day DESC LIMIT 7", (uid,))
-    rows = cur.fetchall()
-    rows = list(reversed(rows))
-    if not rows:
-        return await m.answer("Пока нет настроений за неделю. Поставь пару записей через /mood.")
+# Дайджест считается заранее фоновой задачей в «тихий» час пользователя
+# и хранится в digests; пересчёт только если появились новые настроения.
+DIGEST_HOUR = int(os.getenv("DIGEST_HOUR", "4"))  # локальное время пользователя
+DIGEST_EVERY = int(os.getenv("DIGEST_EVERY", "900"))  # сек между проверками
+DIGEST_CONCURRENCY = int(os.getenv("DIGEST_CONCURRENCY", "3"))
+DIGEST_PROMPT = "Сводка настроения по дням:\n{}\nСделай короткий человеческий обзор (2–3 предложения) и предложи 2–3 мягких шага на следующую неделю."
+
+def _digest_rows(uids) -> dict:
+    """Последние 7 дней со средним настроением для пачки пользователей одним запросом."""
+    out = {}
+    uids = list(uids)
+    for i in range(0, len(uids), 500):
+        chunk = uids[i:i+500]
+        marks = ",".join("?" * len(chunk))
+        cur.execute(f"""SELECT user_id, day, avg FROM (
+                SELECT user_id, day, AVG(score) AS avg,
+                       ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY day DESC) AS rn
+                FROM moods WHERE user_id IN ({marks}) GROUP BY user_id, day)
+            WHERE rn <= 7 ORDER BY user_id, day""", chunk)
+        for uid, day, avg in cur.fetchall():
+            out.setdefault(uid, []).append((day, avg))
+    return out
+
+async def _digest_build(uid: int, rows):
+    """-> (текст дайджеста, удалось ли получить обзор ИИ)"""
     line = []
     summary_input = []
     for day, avg in rows:
@@ -642,10 +1423,68 @@ async def cmd_digest(m: types.Message):
     moodline = "".join(line)
     text_block = "\n".join(summary_input)
     try:
-        ai = await _ai_answer_with_ctx(uid, f"Сводка настроения по дням:\n{text_block}\nСделай короткий человеческий обзор (2–3 предложения) и предложи 2–3 мягких шага на следующую неделю.")
+        # без заметок и переписки: ночная пачка не строит индексы и не вытесняет их из кэша
+        ai = await _ai_reply(uid, DIGEST_PROMPT.format(text_block), context=False)
+        ok = True
     except Exception as e:
         ai = f"(не удалось получить обзор ИИ: {e})"
-    await m.answer(f"Муд недели: {moodline}\n{text_block}\n\n{ai}")
+        ok = False
+    return f"Муд недели: {moodline}\n{text_block}\n\n{ai}", ok
+
+def _digest_store(uid: int, last_mood_id: int, body: str):
+    cur.execute("INSERT INTO digests(user_id,last_mood_id,body) VALUES(?,?,?) ON CONFLICT(user_id) DO UPDATE SET "
+                "last_mood_id=excluded.last_mood_id, body=excluded.body, ts=CURRENT_TIMESTAMP",
+                (uid, last_mood_id, body))
+    db.commit()
+
+async def _digest_batch():
+    # пользователи с новыми настроениями, у которых сейчас «тихий» час
+    cur.execute("""SELECT m.user_id, m.last_id, u.tz
+        FROM (SELECT user_id, MAX(id) AS last_id FROM moods GROUP BY user_id) m
+        LEFT JOIN users u ON u.user_id = m.user_id
+        LEFT JOIN digests d ON d.user_id = m.user_id
+        WHERE d.last_mood_id IS NULL OR d.last_mood_id < m.last_id""")
+    due = {uid: last_id for uid, last_id, tz in cur.fetchall()
+           if _now_in_tz(tz or "Europe/Moscow").hour == DIGEST_HOUR}
+    if not due:
+        return
+    stats = _digest_rows(due)
+    sem = asyncio.Semaphore(DIGEST_CONCURRENCY)
+
+    async def one(uid, rows):
+        async with sem:
+            body, ok = await _digest_build(uid, rows)
+        if ok:
+            _digest_store(uid, due[uid], body)
+
+    await asyncio.gather(*(one(uid, rows) for uid, rows in stats.items()))
+
+async def _digest_loop():
+    while True:
+        try:
+            await asyncio.sleep(DIGEST_EVERY)
+            await _digest_batch()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print("[digest loop]", e)
+
+@dp.message(Command("digest"))
+@dp.message(F.text == "📅 Недельный дайджест")
+async def cmd_digest(m: types.Message):
+    uid = m.from_user.id
+    cur.execute("SELECT MAX(id) FROM moods WHERE user_id=?", (uid,))
+    last_id = cur.fetchone()[0]
+    if not last_id:
+        return await m.answer("Пока нет настроений за неделю. Поставь пару записей через /mood.")
+    cur.execute("SELECT last_mood_id, body FROM digests WHERE user_id=?", (uid,))
+    row = cur.fetchone()
+    if row and row[0] == last_id:
+        return await m.answer(row[1])
+    body, ok = await _digest_build(uid, _digest_rows([uid]).get(uid, []))
+    if ok:
+        _digest_store(uid, last_id, body)
+    await m.answer(body)
 
 # ── SMART TEXT HANDLER (не просто эхо) ─────────────────────────────────────
 @dp.message(F.text & ~F.text.startswith("/"))
@@ -664,6 +1503,216 @@ async def smart_text(m: types.Message):
     log_chat(m.from_user.id, 'assistant', resp)
     await m.answer(resp)
 
+# ── MEMORY ─────────────────────────────────────────────────────────────────
+MEM_SAMPLE_EVERY = int(os.getenv("MEM_SAMPLE_EVERY", "60"))
+_rss_history = deque(maxlen=180)  # (unix ts, RSS MB) — 3 часа при шаге в минуту
+
+async def _mem_loop():
+    pressure = False
+    while True:
+        try:
+            await asyncio.sleep(MEM_SAMPLE_EVERY)
+            for c in _caches.values():
+                c.purge()
+            rss = _rss_mb()
+            _rss_history.append((int(time.time()), round(rss, 1)))
+            # у самого края бюджета один раз сбрасываем то, что можно пересобрать из БД;
+            # снова — только после того, как RSS опустится ниже 80%, иначе при бюджете
+            # около базового RSS кэш чистился бы каждую минуту
+            if rss > MEMORY_BUDGET_MB * 0.9 and not pressure:
+                pressure = True
+                print(f"[mem] RSS {rss:.0f}MB close to budget {MEMORY_BUDGET_MB}MB, dropping notes cache")
+                _note_index.clear()
+            elif rss < MEMORY_BUDGET_MB * 0.8:
+                pressure = False
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print("[mem loop]", e)
+
+def _trace_top(top: int) -> list:
+    # снимок и группировка на долгоживущем процессе занимают секунды — не в event loop
+    key = "traceback" if tracemalloc.get_traceback_limit() > 1 else "lineno"
+    stats = tracemalloc.take_snapshot().statistics(key)
+    return [{"where": " <- ".join(str(f) for f in reversed(st.traceback)), "kb": round(st.size / 1024, 1),
+             "count": st.count} for st in stats[:top]]
+
+async def memory_handler(request: web.Request):
+    if not _admin_ok(request):
+        return web.json_response({"ok": False, "error": "forbidden"}, status=403)
+    q = request.query
+    try:
+        frames = int(q.get("frames", "1"))
+        top = int(q.get("top", "20"))
+    except ValueError:
+        return web.json_response({"ok": False, "error": "bad frames/top"}, status=400)
+    frames = min(max(frames, 1), 16)
+    top = min(max(top, 1), 500)
+    trace = q.get("trace")
+    if trace == "on" and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    elif trace == "off" and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    out = {
+        "ok": True,
+        "budget_mb": MEMORY_BUDGET_MB,
+        "baseline_mb": round(RSS_BASELINE_MB, 1),
+        "headroom_mb": round(MEMORY_HEADROOM_MB, 1),
+        "rss_mb": round(_rss_mb(), 1),
+        "rss_history": list(_rss_history),
+        "caches": {name: {"size": len(c), "max": c.maxsize, "bytes": c.weight} for name, c in _caches.items()},
+        "tracing": tracemalloc.is_tracing(),
+    }
+    if tracemalloc.is_tracing():
+        cur_b, peak_b = tracemalloc.get_traced_memory()
+        out["traced_mb"] = round(cur_b / 1048576, 2)
+        out["traced_peak_mb"] = round(peak_b / 1048576, 2)
+        out["top"] = await asyncio.to_thread(_trace_top, top)
+    return web.json_response(out)
+
+# ── PROFILER ───────────────────────────────────────────────────────────────
+# Сэмплирующий профайлер по запросу: ITIMER_REAL раз в 1/hz сек шлёт SIGALRM,
+# обработчик исполняется в главном потоке (там же event loop) и получает прерванный
+# кадр. В отличие от сэмплера в отдельном потоке, он не зависит от того, кто держит
+# GIL, поэтому CPU-работа хендлеров не прячется в «(idle)». Заодно снимаются стеки
+# потоков asyncio.to_thread (ИИ, импорт, индекс заметок) с меткой «worker:функция».
+PROFILE_HZ = int(os.getenv("PROFILE_HZ", "200"))
+PROFILE_MAX_SECONDS = 120
+PROFILE_MAX_DEPTH = 64
+
+class _Sampler:
+    def __init__(self, hz: int, max_updates: int):
+        self.interval = 1.0 / hz
+        self.max_updates = max_updates
+        self.updates = 0
+        self.samples = 0
+        self.stacks = Counter()
+        self.handlers = Counter()
+        self.labels = _profile_labels()
+        self.files = {_ritual_loop.__code__.co_filename}
+        if llm_short_reply is not None:
+            self.files.add(llm_short_reply.__code__.co_filename)
+        self.done = asyncio.Event()
+        self.prev = None
+        self.last = 0.0
+
+    def start(self):
+        self.prev = signal.signal(signal.SIGALRM, self._tick)
+        self.last = time.monotonic()
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+
+    def close(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self.prev if self.prev is not None else signal.SIG_DFL)
+
+    def _tick(self, signum, frame):
+        now = time.monotonic()
+        # сигнал во время долгого C-вызова (sqlite, zlib) доставляется один раз,
+        # поэтому сэмпл весит столько тиков, сколько прошло с прошлого
+        n = max(1, round((now - self.last) / self.interval))
+        self.last = now
+        if frame is not None:
+            self._add(frame, n, False)
+        main = threading.get_ident()
+        workers = {t.ident for t in threading.enumerate() if t.name.startswith("asyncio")}
+        for tid, f in sys._current_frames().items():
+            if tid != main and tid in workers:
+                self._add(f, n, True)
+
+    def _add(self, frame, n: int, worker: bool):
+        leaf = frame.f_code.co_filename
+        names = []
+        label = None
+        while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+            code = frame.f_code
+            # самый внешний хендлер на стеке: btn_time -> cmd_menu считается как btn_time;
+            # в рабочем потоке — самая внешняя наша функция (short_reply, _run_import)
+            if worker:
+                if code.co_filename in self.files:
+                    label = code.co_name
+            else:
+                label = self.labels.get(code, label)
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        if worker:
+            if label is None:
+                return  # свободный поток пула или чужая работа (DNS)
+            label = f"worker:{label}"
+        else:
+            self.samples += n
+            if label is None:
+                label = "(idle)" if leaf.endswith("selectors.py") else "(other)"
+        names.append(label)
+        self.handlers[label] += n
+        self.stacks[";".join(reversed(names))] += n
+
+def _profile_labels() -> dict:
+    labels = {}
+    for observer in dp.observers.values():
+        for h in observer.handlers:
+            code = getattr(h.callback, "__code__", None)
+            # только наши хендлеры, без внутреннего _listen_update диспетчера
+            if code is not None and getattr(h.callback, "__module__", None) == __name__:
+                labels[code] = h.callback.__name__
+    for fn in (_ritual_loop, _digest_loop, _mem_loop, _weather_loop, start_background):
+        labels[fn.__code__] = fn.__name__
+    return labels
+
+_profiler = None
+
+@dp.update.outer_middleware()
+async def _profile_count_updates(handler, event, data):
+    try:
+        return await handler(event, data)
+    finally:
+        p = _profiler
+        if p is not None:
+            p.updates += 1
+            if p.max_updates and p.updates >= p.max_updates:
+                p.done.set()
+
+async def profile_handler(request: web.Request):
+    global _profiler
+    if not _admin_ok(request):
+        return web.json_response({"ok": False, "error": "forbidden"}, status=403)
+    if _profiler is not None:
+        return web.json_response({"ok": False, "error": "profiler is already running"}, status=409)
+    if not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        return web.json_response({"ok": False, "error": "profiler needs SIGALRM in the main thread"}, status=501)
+    q = request.query
+    try:
+        updates = int(q.get("updates", "0"))
+        seconds = float(q.get("seconds", "0")) or (PROFILE_MAX_SECONDS if updates else 10.0)
+        hz = int(q.get("hz", PROFILE_HZ))
+        # float() принимает nan/inf: с таким таймаутом wait_for не закончится никогда
+        if not math.isfinite(seconds):
+            raise ValueError(seconds)
+    except ValueError:
+        return web.json_response({"ok": False, "error": "bad seconds/updates/hz"}, status=400)
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    hz = min(max(hz, 1), 1000)
+    p = _profiler = _Sampler(hz, updates)
+    t0 = time.monotonic()
+    p.start()
+    try:
+        await asyncio.wait_for(p.done.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        p.close()
+        _profiler = None
+    if q.get("format") == "json":
+        return web.json_response({
+            "ok": True,
+            "seconds": round(time.monotonic() - t0, 2),
+            "samples": p.samples,
+            "updates": p.updates,
+            "handlers": dict(p.handlers.most_common()),
+            "stacks": dict(p.stacks.most_common(200)),
+        })
+    # collapsed stacks: «label;root;...;leaf count» — формат flamegraph.pl / speedscope
+    return web.Response(text="\n".join(f"{stack} {n}" for stack, n in p.stacks.most_common()) + "\n")
+
 # ── STARTUP ────────────────────────────────────────────────────────────────
 async def _set_commands():
     cmds = [
@@ -733,8 +1782,32 @@ async def _ritual_loop():
 async def on_startup(app: web.Application):
     app["task"] = asyncio.create_task(start_background())
     app["scheduler"] = asyncio.create_task(_ritual_loop())
+    app["digests"] = asyncio.create_task(_digest_loop())
+    app["mem"] = asyncio.create_task(_mem_loop())
+    app["weather"] = asyncio.create_task(_weather_loop())
 
 async def on_cleanup(app: web.Application):
+    weather = app.get("weather")
+    if weather:
+        weather.cancel()
+        try:
+            await weather
+        except Exception:
+            pass
+    mem = app.get("mem")
+    if mem:
+        mem.cancel()
+        try:
+            await mem
+        except Exception:
+            pass
+    digests = app.get("digests")
+    if digests:
+        digests.cancel()
+        try:
+            await digests
+        except Exception:
+            pass
     sched = app.get("scheduler")
     if sched:
         sched.cancel()
@@ -760,6 +1833,9 @@ def create_app() -> web.Application:
         return web.json_response({"ok": True})
 
     app.router.add_get("/", ping_handler)
+    app.router.add_post("/import/{uid}", import_handler)
+    app.router.add_get("/debug/memory", memory_handler)
+    app.router.add_get("/debug/profile", profile_handler)
 
     if USE_WEBHOOK:
         async def hook_get(_):
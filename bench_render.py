@@ -0,0 +1,43 @@
+"""
+Микробенчмарк сериализации ответа: сколько стоит собрать form-data для
+sendMessage с клавиатурой — как раньше (новая ReplyKeyboardMarkup на каждый
+ответ, обычная сессия) и через _PreparedSession с общей клавиатурой.
+
+    python bench_render.py [итераций]
+"""
+import os
+import sys
+import timeit
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench-token")
+os.environ.setdefault("DB_PATH", ":memory:")
+os.environ.setdefault("USE_WEBHOOK", "0")
+
+import app
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import SendMessage
+from aiogram.types import ReplyKeyboardMarkup
+
+def fresh_keyboard():
+    # как было до кэша: новая клавиатура с валидацией на каждый ответ
+    return ReplyKeyboardMarkup.model_validate(app.main_keyboard().model_dump())
+
+def main(n: int):
+    plain, prepared = AiohttpSession(), app._PreparedSession()
+    kb = app.main_keyboard()
+    a = plain.build_form_data(app.bot, SendMessage(chat_id=1, text="x", reply_markup=fresh_keyboard()))
+    b = prepared.build_form_data(app.bot, SendMessage(chat_id=1, text="x", reply_markup=kb))
+    assert a._fields == b._fields, "prepared payload differs"
+
+    def old():
+        plain.build_form_data(app.bot, SendMessage(chat_id=1, text=app.HELP_TEXT, reply_markup=fresh_keyboard()))
+
+    def new():
+        prepared.build_form_data(app.bot, SendMessage(chat_id=1, text=app.HELP_TEXT, reply_markup=kb))
+
+    for name, fn in (("new keyboard + plain session", old), ("shared keyboard + prepared session", new)):
+        best = min(timeit.repeat(fn, number=n, repeat=5))
+        print(f"{name:36s} {best / n * 1e6:8.1f} us/reply")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -3,16 +3,84 @@
 Опциональный модуль для ответов ИИ с поддержкой персонального "характера".
 Если OPENAI_API_KEY не задан, функции не используются.
 Сделано минимально, чтобы не увеличивать потребление памяти.
+
+Можно задать запасные эндпоинты и модели (OPENAI_FALLBACK_BASE_URLS,
+OPENAI_FALLBACK_MODELS): при ошибке или таймауте запрос уходит следующему,
+упавший эндпоинт на время выключается (circuit breaker). Модели пробуются
+в порядке из конфигурации, а из эндпоинтов с одной и той же моделью первым
+идёт самый быстрый по недавним ответам; эндпоинт, к которому давно
+не обращались, раз в BREAKER_COOLDOWN получает запрос-пробу. Сетевые ошибки и таймауты
+выключают весь base URL сразу для всех моделей, 5xx/429 — только пару
+(base, модель); ошибки самого запроса (400, 422 и т.п.) не считаются.
 """
 import os
+import time
 from functools import lru_cache
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APIStatusError
 
 MODEL   = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 API_KEY = os.getenv("OPENAI_API_KEY")
 BASE    = os.getenv("OPENAI_BASE_URL")
 TEMP    = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
 MAXTOK  = int(os.getenv("OPENAI_MAX_TOKENS", "220"))
+TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+
+def _csv_env(name: str) -> list:
+    return [x.strip() for x in os.getenv(name, "").split(",")]
+
+# Порядок в списках = приоритет. Ключи для запасных URL — по позиции, иначе OPENAI_API_KEY.
+_fb_bases = [b for b in _csv_env("OPENAI_FALLBACK_BASE_URLS") if b]
+_fb_keys  = _csv_env("OPENAI_FALLBACK_API_KEYS")
+ENDPOINTS = [(BASE, API_KEY)] + [
+    (b, (_fb_keys[i] if i < len(_fb_keys) and _fb_keys[i] else API_KEY)) for i, b in enumerate(_fb_bases)
+]
+MODELS = [MODEL] + [m for m in _csv_env("OPENAI_FALLBACK_MODELS") if m]
+
+BREAKER_FAILS    = int(os.getenv("BREAKER_FAILS", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "60"))
+LATENCY_GUESS    = 5.0  # сек, для ещё не опрошенных целей
+
+# (base, model) -> [подряд ошибок, закрыт до (monotonic), EWMA задержки или None, последняя попытка]
+_health = {}
+# base -> [подряд ошибок, закрыт до]: сеть/таймаут/ключ, общие для всех моделей
+_base_health = {}
+
+def _targets():
+    now = time.monotonic()
+    all_ = [(b, k, m) for b, k in ENDPOINTS for m in MODELS]
+    for t in all_:
+        _health.setdefault((t[0], t[2]), [0, 0.0, None, 0.0])
+        _base_health.setdefault(t[0], [0, 0.0])
+    alive = [t for t in all_ if _base_health[t[0]][1] <= now and _health[(t[0], t[2])][1] <= now] or all_
+    # модель из конфигурации главнее задержки: иначе один сбой основной модели навсегда
+    # уводит запросы на запасную. Среди эндпоинтов одной модели давно не опрошенный идёт
+    # первым, чтобы обновить его задержку после сбоя. sorted стабилен — при равенстве
+    # сохраняется порядок из конфигурации
+    def key(t):
+        h = _health[(t[0], t[2])]
+        return MODELS.index(t[2]), now - h[3] < BREAKER_COOLDOWN, h[2] or LATENCY_GUESS
+    return sorted(alive, key=key)
+
+def _mark_ok(h, dt: float):
+    h[0] = 0
+    h[2] = dt if h[2] is None else 0.7 * h[2] + 0.3 * dt
+
+def _base_error(e: Exception) -> bool:
+    # недоступен сам эндпоинт (или не подходит ключ) — другие модели там не помогут
+    if isinstance(e, APIConnectionError):
+        return True
+    return isinstance(e, APIStatusError) and e.status_code in (401, 403)
+
+def _target_error(e: Exception) -> bool:
+    # перегрузка или сбой конкретной модели; прочие 4xx — ошибка запроса, не отказ
+    if isinstance(e, APIStatusError):
+        return e.status_code >= 500 or e.status_code in (404, 429)
+    return True
+
+def _mark_fail(h):
+    h[0] += 1
+    if h[0] >= BREAKER_FAILS:
+        h[1] = time.monotonic() + BREAKER_COOLDOWN
 
 @lru_cache(maxsize=1)
 def _load_persona() -> str:
@@ -32,14 +100,17 @@ def _load_persona() -> str:
     # 3) Fallback: empty (персона не меняется наружу)
     return ""
 
-_client = None
-def client():
-    global _client
-    if _client is None:
-        if not API_KEY:
+_clients = {}
+def client(base=BASE, key=API_KEY):
+    c = _clients.get(base)
+    if c is None:
+        if not key:
             raise RuntimeError("OPENAI_API_KEY is empty")
-        _client = OpenAI(api_key=API_KEY, base_url=BASE) if BASE else OpenAI(api_key=API_KEY)
-    return _client
+        # без встроенных ретраев: вместо них переключаемся на следующую цель
+        kw = {"api_key": key, "timeout": TIMEOUT, "max_retries": 0}
+        c = OpenAI(base_url=base, **kw) if base else OpenAI(**kw)
+        _clients[base] = c
+    return c
 
 def short_reply(prompt: str) -> str:
     persona = _load_persona()
@@ -47,11 +118,29 @@ def short_reply(prompt: str) -> str:
     if persona:
         messages.append({"role": "system", "content": persona})
     messages.append({"role": "user", "content": prompt})
-    c = client()
-    r = c.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        temperature=TEMP,
-        max_tokens=MAXTOK
-    )
-    return (r.choices[0].message.content or "").strip()
+    err = None
+    dead = set()
+    for base, key, model in _targets():
+        if base in dead:
+            continue
+        h = _health[(base, model)]
+        t0 = h[3] = time.monotonic()
+        try:
+            r = client(base, key).chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=TEMP,
+                max_tokens=MAXTOK
+            )
+        except Exception as e:
+            err = e
+            if _base_error(e):
+                _mark_fail(_base_health[base])
+                dead.add(base)
+            elif _target_error(e):
+                _mark_fail(h)
+            continue
+        _base_health[base][0] = 0
+        _mark_ok(h, time.monotonic() - t0)
+        return (r.choices[0].message.content or "").strip()
+    raise err or RuntimeError("no LLM endpoints configured")